@@ -1,17 +1,184 @@
 import asyncio
-import json
-import requests
-from typing import Dict, List, Optional
+import hashlib
+import importlib.util
+import logging
+import os
+import re
+import threading
+import time
+import httpx
+from collections import OrderedDict
+from urllib.parse import urlsplit
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
 from aiohttp import web
 from server import PromptServer
 
-# Simple in-memory stores for chat state.
-_chat_sessions: Dict[str, List[Dict[str, str]]] = {}
+try:
+    import orjson
+
+    _json_dumps = orjson.dumps
+    _json_loads = orjson.loads
+except ImportError:
+    import json
+
+    def _json_dumps(obj) -> bytes:
+        return json.dumps(obj).encode("utf-8")
+
+    _json_loads = json.loads
+
+@dataclass
+class Session:
+    messages: List[Dict[str, str]] = field(default_factory=list)
+    # Index of the latest assistant message in `messages`, -1 if there is none.
+    last_assistant_idx: int = -1
+    # readable_history cache: the first `rendered_len` messages rendered as `rendered_str`.
+    rendered_len: int = 0
+    rendered_str: str = ""
+
+# Simple in-memory stores for chat state, least recently used sessions evicted first.
+_chat_sessions: "OrderedDict[str, Session]" = OrderedDict()
+_MAX_SESSIONS = 256
+# Leading system prompt is always kept; older turns beyond this many messages are dropped.
+_MAX_HISTORY_MESSAGES = 200
 
 REQUEST_TIMEOUT = 60
+# Character budget for the history sent upstream; 0 disables compaction.
+MAX_CONTEXT_CHARS = 8000
+
+# Upper bound on concurrent upstream LLM calls; match it to OLLAMA_NUM_PARALLEL.
+_DEFAULT_MAX_PARALLEL = 4
+
+def _read_max_parallel() -> int:
+    raw = os.environ.get("CHAT_OPTIMIZE_MAX_PARALLEL", "")
+    if not raw.strip():
+        return _DEFAULT_MAX_PARALLEL
+    try:
+        return max(1, int(raw))
+    except ValueError:
+        logging.warning(
+            "[ChatOptimize] ignoring non-integer CHAT_OPTIMIZE_MAX_PARALLEL=%r; using %d",
+            raw,
+            _DEFAULT_MAX_PARALLEL,
+        )
+        return _DEFAULT_MAX_PARALLEL
+
+MAX_PARALLEL = _read_max_parallel()
+_UPSTREAM_SEM = asyncio.Semaphore(MAX_PARALLEL)
+
+logging.info(
+    "[ChatOptimize] up to %d concurrent LLM calls (CHAT_OPTIMIZE_MAX_PARALLEL); "
+    "set OLLAMA_NUM_PARALLEL and OLLAMA_MAX_LOADED_MODELS on the Ollama server to match.",
+    MAX_PARALLEL,
+)
 
-def _build_headers() -> Dict[str, str]:
-    return {"Content-Type": "application/json"}
+# Shared httpx client for every provider; HTTP/2 lets concurrent turns to one host
+# multiplex over a single connection when the `h2` package is installed.
+_HTTP: Optional[httpx.AsyncClient] = None
+_HTTP_LOOP: Optional[asyncio.AbstractEventLoop] = None
+_HTTP_LOCK = threading.Lock()
+_HTTP2 = importlib.util.find_spec("h2") is not None
+_KEEPALIVE_EXPIRY = 60
+
+async def get_client() -> httpx.AsyncClient:
+    global _HTTP, _HTTP_LOOP
+    loop = asyncio.get_running_loop()
+    with _HTTP_LOCK:
+        # The connection pool is bound to the loop it was first used on; rebuild it if that loop changed.
+        if _HTTP is None or _HTTP.is_closed or _HTTP_LOOP is not loop:
+            if _HTTP is not None:
+                # Connections warmed on the old client are gone with it.
+                _warm_origins.clear()
+            _HTTP = httpx.AsyncClient(
+                http2=_HTTP2,
+                limits=httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=_KEEPALIVE_EXPIRY),
+                timeout=httpx.Timeout(REQUEST_TIMEOUT),
+                # Every body is pre-encoded JSON bytes, so the content type is set once here.
+                headers={"Content-Type": "application/json"},
+            )
+            _HTTP_LOOP = loop
+        return _HTTP
+
+def _run_sync(coro):
+    # ComfyUI executes nodes on a worker thread; hand the coroutine to the server loop
+    # so node executions and the HTTP endpoint share one client.
+    loop = getattr(PromptServer.instance, "loop", None)
+    if loop is not None and loop.is_running():
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            # Blocking here would stall every request on the server; async callers must await achat.
+            coro.close()
+            raise RuntimeError("ChatNode.chat called on the server event loop; await ChatNode.achat instead")
+        return asyncio.run_coroutine_threadsafe(coro, loop).result()
+    return asyncio.run(coro)
+
+# origin -> last time it was warmed or about to be used; a fresh entry means the pool
+# should still hold a live keep-alive connection to it.
+_warm_origins: Dict[str, float] = {}
+# Strong references to in-flight warm-up tasks.
+_warm_tasks: set = set()
+
+_HF_DEFAULT_HOST = "https://api-inference.huggingface.co"
+
+def _provider_endpoint(provider: str, base_url: str, hf_api_url: str = "") -> str:
+    if provider == "huggingface":
+        return hf_api_url or _HF_DEFAULT_HOST
+    return base_url
+
+def _origin(url: str) -> str:
+    parts = urlsplit(url or "")
+    if parts.scheme not in ("http", "https") or not parts.netloc:
+        return ""
+    return f"{parts.scheme}://{parts.netloc}"
+
+async def _touch(url: str):
+    client = await get_client()
+    try:
+        await client.head(url, timeout=2)
+    except Exception:
+        pass
+
+def _start_warm(url: str):
+    task = asyncio.get_running_loop().create_task(_touch(url))
+    _warm_tasks.add(task)
+    task.add_done_callback(_warm_tasks.discard)
+
+def _warm_endpoint(url: str):
+    """
+    Open a pooled connection to `url`'s host in the background so the next request skips
+    the TCP/TLS handshake. Skipped while the host was seen within the keep-alive window.
+    Safe to call from the ComfyUI worker thread or from the server loop.
+    """
+    origin = _origin(url)
+    if not origin:
+        return
+    now = time.monotonic()
+    last = _warm_origins.get(origin)
+    _warm_origins[origin] = now
+    if last is not None and now - last < _KEEPALIVE_EXPIRY:
+        return
+    loop = getattr(PromptServer.instance, "loop", None)
+    if loop is not None and not loop.is_closed():
+        # Any response, even a 404/405, leaves the connection in the pool.
+        loop.call_soon_threadsafe(_start_warm, origin + "/")
+
+# Opt-in (CHAT_OPTIMIZE_PREWARM=1): a default start must not contact third-party hosts.
+# Only these default endpoints are warmed at startup; configured ones are warmed on first use.
+_PREWARM_URLS = (
+    "http://127.0.0.1:11434",
+    _HF_DEFAULT_HOST,
+)
+
+def _schedule_prewarm():
+    if os.environ.get("CHAT_OPTIMIZE_PREWARM", "0") != "1":
+        return
+    for url in _PREWARM_URLS:
+        _warm_endpoint(url)
+
+_FENCE_RE = re.compile(r"\A```[^\n]*\n(.*?)\n?```\Z", re.DOTALL)
 
 def _clean_llm_output(text: str) -> str:
     """
@@ -19,25 +186,20 @@ def _clean_llm_output(text: str) -> str:
     Removes Markdown code blocks, JSON wrapping if present, and extra whitespace.
     """
     text = text.strip()
-    if text.startswith("```") and text.endswith("```"):
-        lines = text.splitlines()
-        if lines[0].startswith("```"):
-            lines = lines[1:]
-        if lines and lines[-1].strip() == "```":
-            lines = lines[:-1]
-        text = "\n".join(lines).strip()
-    return text
+    match = _FENCE_RE.match(text)
+    return match.group(1).strip() if match else text
 
-def _call_ollama_chat(
+async def _call_ollama_chat_async(
     base_url: str,
     model: str,
     messages: List[Dict[str, str]],
     seed: Optional[int] = None,
     other_options: Optional[Dict] = None,
     timeout: int = REQUEST_TIMEOUT,
+    session_id: Optional[str] = None,
 ) -> str:
     url = base_url.rstrip("/") + "/api/chat"
-    payload = {"model": model, "messages": messages, "stream": False}
+    payload = {"model": model, "messages": messages, "stream": True}
     
     options = {}
     if seed is not None:
@@ -48,28 +210,204 @@ def _call_ollama_chat(
     if options:
         payload["options"] = options
 
-    resp = requests.post(url, headers=_build_headers(), data=json.dumps(payload), timeout=timeout)
-    resp.raise_for_status()
-    data = resp.json()
-    return data.get("message", {}).get("content", "")
+    client = await get_client()
+    parts: List[str] = []
+    try:
+        async with _UPSTREAM_SEM, client.stream(
+            "POST", url, content=_json_dumps(payload), timeout=timeout
+        ) as resp:
+            resp.raise_for_status()
+            # NDJSON stream: forward each fragment to the frontend as it arrives. The loop runs
+            # to the end of the body (past `done`) so the connection goes back to the pool.
+            async for line in resp.aiter_lines():
+                if not line.strip():
+                    continue
+                data = _json_loads(line)
+                if data.get("error"):
+                    raise RuntimeError(data.get("error"))
+                delta = data.get("message", {}).get("content", "")
+                if delta:
+                    parts.append(delta)
+                    await PromptServer.instance.send(
+                        "chat_optimize.token", {"session_id": session_id, "delta": delta}
+                    )
+    finally:
+        # Lets the frontend close its streaming preview, also when the call failed.
+        await PromptServer.instance.send("chat_optimize.done", {"session_id": session_id})
+    return "".join(parts)
+
+_ROLE_PREFIX = {"system": "System: ", "user": "User: ", "assistant": "Assistant: "}
 
 def _build_hf_prompt(messages: List[Dict[str, str]]) -> str:
-    lines: List[str] = []
+    parts: List[str] = []
     for msg in messages:
         role = msg.get("role", "user")
-        content = msg.get("content", "")
-        if role == "system":
-            lines.append(f"System: {content}")
-        elif role == "user":
-            lines.append(f"User: {content}")
-        elif role == "assistant":
-            lines.append(f"Assistant: {content}")
+        parts.append(_ROLE_PREFIX.get(role) or f"{role.capitalize()}: ")
+        parts.append(msg.get("content", ""))
+        parts.append("\n")
+    parts.append("Assistant:")
+    return "".join(parts).strip()
+
+def _extract_hf_text(item: object, prompt: str) -> str:
+    if isinstance(item, list) and item:
+        item = item[0]
+
+    generated_text = ""
+    if isinstance(item, dict):
+        generated_text = item.get("generated_text", "")
+    elif isinstance(item, str):
+        generated_text = item
+
+    # Endpoints that ignore return_full_text still echo the prompt.
+    if generated_text.startswith(prompt):
+        generated_text = generated_text[len(prompt):]
+
+    return generated_text.strip()
+
+class _BatchRejected(RuntimeError):
+    """The endpoint answered a list-input request with something other than one result per prompt."""
+
+def _is_batch_rejection(exc: BaseException) -> bool:
+    if isinstance(exc, _BatchRejected):
+        return True
+    return isinstance(exc, httpx.HTTPStatusError) and exc.response.status_code in (400, 422)
+
+class _HFBatcher:
+    """
+    Coalesce HF prompts that arrive within a short window into list-input requests.
+    Prompts are only grouped when endpoint, token and generation parameters all match.
+    Endpoints that reject list inputs (e.g. TGI behind `hf_api_url`) are remembered
+    and served one prompt per request from then on.
+    """
+
+    def __init__(self, window: float = 0.03, max_batch: int = 8):
+        self.window = window
+        self.max_batch = max_batch
+        self._queue: Optional[asyncio.Queue] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        # Strong references to the worker and flush tasks so they are not collected mid-run.
+        self._tasks: set = set()
+        # URLs that rejected a list-input request.
+        self._unbatched: set = set()
+
+    def _spawn(self, loop: asyncio.AbstractEventLoop, coro):
+        task = loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def submit(
+        self,
+        url: str,
+        token: str,
+        prompt: str,
+        parameters: Dict[str, object],
+        timeout: int = REQUEST_TIMEOUT,
+    ) -> str:
+        if url in self._unbatched:
+            return (await self._post(url, token, [prompt], parameters, timeout))[0]
+
+        loop = asyncio.get_running_loop()
+        if self._queue is None or self._loop is not loop:
+            self._queue = asyncio.Queue()
+            self._loop = loop
+            self._spawn(loop, self._run(self._queue))
+        future = loop.create_future()
+        key = (url, token, tuple(sorted(parameters.items())), timeout)
+        await self._queue.put((key, prompt, future))
+        return await future
+
+    async def _run(self, queue: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        while True:
+            key, prompt, future = await queue.get()
+            groups: Dict[tuple, List[tuple]] = {key: [(prompt, future)]}
+            pending = 1
+            deadline = loop.time() + self.window
+            while pending < self.max_batch:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    other_key, other_prompt, other_future = await asyncio.wait_for(queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                groups.setdefault(other_key, []).append((other_prompt, other_future))
+                pending += 1
+            for group_key, items in groups.items():
+                self._spawn(loop, self._flush(group_key, items))
+
+    async def _flush(self, key: tuple, items: List[tuple]):
+        url, token, parameters, timeout = key
+        prompts = [prompt for prompt, _ in items]
+        try:
+            texts = await self._post(url, token, prompts, dict(parameters), timeout)
+        except Exception as exc:
+            if len(items) > 1 and _is_batch_rejection(exc):
+                # Only a malformed-request answer means batching itself is the problem; stop
+                # batching for this URL and send each prompt on its own.
+                self._unbatched.add(url)
+                await asyncio.gather(*(self._flush_one(key, item) for item in items))
+                return
+            # Timeouts, auth errors, 429 and 5xx would fail the same way again.
+            for _, future in items:
+                self._settle(future, exc=exc)
+            return
+        for (_, future), text in zip(items, texts):
+            self._settle(future, text)
+
+    async def _flush_one(self, key: tuple, item: tuple):
+        url, token, parameters, timeout = key
+        prompt, future = item
+        try:
+            texts = await self._post(url, token, [prompt], dict(parameters), timeout)
+        except Exception as exc:
+            self._settle(future, exc=exc)
+            return
+        self._settle(future, texts[0])
+
+    @staticmethod
+    def _settle(future: asyncio.Future, result: str = "", exc: Optional[BaseException] = None):
+        if future.done():
+            return
+        if exc is not None:
+            future.set_exception(exc)
         else:
-            lines.append(f"{role.capitalize()}: {content}")
-    lines.append("Assistant:")
-    return "\n".join(lines).strip()
+            future.set_result(result)
+
+    async def _post(
+        self,
+        url: str,
+        token: str,
+        prompts: List[str],
+        parameters: Dict[str, object],
+        timeout: int,
+    ) -> List[str]:
+        headers = {"Authorization": f"Bearer {token}"} if token else None
+
+        # A single prompt keeps the plain-string form every HF endpoint accepts.
+        payload: Dict[str, object] = {"inputs": prompts if len(prompts) > 1 else prompts[0]}
+        if parameters:
+            payload["parameters"] = parameters
+
+        client = await get_client()
+        async with _UPSTREAM_SEM:
+            resp = await client.post(url, headers=headers, content=_json_dumps(payload), timeout=timeout)
+        resp.raise_for_status()
+        data = _json_loads(resp.content)
+
+        if isinstance(data, dict) and data.get("error"):
+            raise RuntimeError(data.get("error"))
+
+        if len(prompts) == 1:
+            return [_extract_hf_text(data, prompts[0])]
+        if not isinstance(data, list) or len(data) != len(prompts):
+            raise _BatchRejected("Unexpected batched response from Hugging Face Inference API")
+        return [_extract_hf_text(item, prompt) for item, prompt in zip(data, prompts)]
 
-def _call_hf_inference(
+_hf_batcher = _HFBatcher()
+
+async def _call_hf_inference_async(
     model: str,
     token: str,
     messages: List[Dict[str, str]],
@@ -80,12 +418,10 @@ def _call_hf_inference(
     timeout: int = REQUEST_TIMEOUT,
 ) -> str:
     url = api_url or f"https://api-inference.huggingface.co/models/{model}"
-    headers = _build_headers()
-    if token:
-        headers["Authorization"] = f"Bearer {token}"
 
     prompt = _build_hf_prompt(messages)
-    parameters: Dict[str, object] = {}
+    # Ask the endpoint for the completion only instead of echoing the prompt back.
+    parameters: Dict[str, object] = {"return_full_text": False}
     if temperature is not None:
         parameters["temperature"] = temperature
     if top_p is not None:
@@ -93,31 +429,7 @@ def _call_hf_inference(
     if max_new_tokens is not None:
         parameters["max_new_tokens"] = int(max_new_tokens)
 
-    payload: Dict[str, object] = {"inputs": prompt}
-    if parameters:
-        payload["parameters"] = parameters
-
-    resp = requests.post(url, headers=headers, data=json.dumps(payload), timeout=timeout)
-    resp.raise_for_status()
-    data = resp.json()
-
-    if isinstance(data, dict) and data.get("error"):
-        raise RuntimeError(data.get("error"))
-
-    item = data
-    if isinstance(data, list) and data:
-        item = data[0]
-
-    generated_text = ""
-    if isinstance(item, dict):
-        generated_text = item.get("generated_text", "")
-    elif isinstance(item, str):
-        generated_text = item
-
-    if generated_text.startswith(prompt):
-        generated_text = generated_text[len(prompt):]
-
-    return generated_text.strip()
+    return await _hf_batcher.submit(url, token, prompt, parameters, timeout)
 
 def _build_openai_compatible_url(base_url: str) -> str:
     base = (base_url or "").rstrip("/")
@@ -125,7 +437,7 @@ def _build_openai_compatible_url(base_url: str) -> str:
         return base
     return base + "/chat/completions"
 
-def _call_openai_compatible_chat(
+async def _call_openai_compatible_chat_async(
     base_url: str,
     model: str,
     api_key: str,
@@ -136,9 +448,7 @@ def _call_openai_compatible_chat(
     timeout: int = REQUEST_TIMEOUT,
 ) -> str:
     url = _build_openai_compatible_url(base_url)
-    headers = _build_headers()
-    if api_key:
-        headers["Authorization"] = f"Bearer {api_key}"
+    headers = {"Authorization": f"Bearer {api_key}"} if api_key else None
 
     payload: Dict[str, object] = {
         "model": model,
@@ -152,9 +462,11 @@ def _call_openai_compatible_chat(
     if max_new_tokens is not None:
         payload["max_tokens"] = int(max_new_tokens)
 
-    resp = requests.post(url, headers=headers, data=json.dumps(payload), timeout=timeout)
+    client = await get_client()
+    async with _UPSTREAM_SEM:
+        resp = await client.post(url, headers=headers, content=_json_dumps(payload), timeout=timeout)
     resp.raise_for_status()
-    data = resp.json()
+    data = _json_loads(resp.content)
 
     if isinstance(data, dict) and data.get("error"):
         raise RuntimeError(data.get("error"))
@@ -176,7 +488,7 @@ def _split_system_messages(messages: List[Dict[str, str]]):
             non_system.append(msg)
     return ("\n\n".join([p for p in system_parts if p]), non_system)
 
-def _call_anthropic_messages(
+async def _call_anthropic_messages_async(
     base_url: str,
     model: str,
     api_key: str,
@@ -193,10 +505,9 @@ def _call_anthropic_messages(
         url = base + "/messages"
     else:
         url = base + "/v1/messages"
-    headers = _build_headers()
+    headers = {"anthropic-version": "2023-06-01"}
     if api_key:
         headers["x-api-key"] = api_key
-    headers["anthropic-version"] = "2023-06-01"
 
     system_prompt, non_system = _split_system_messages(messages)
     formatted_messages: List[Dict[str, object]] = []
@@ -219,9 +530,11 @@ def _call_anthropic_messages(
     if top_p is not None:
         payload["top_p"] = top_p
 
-    resp = requests.post(url, headers=headers, data=json.dumps(payload), timeout=timeout)
+    client = await get_client()
+    async with _UPSTREAM_SEM:
+        resp = await client.post(url, headers=headers, content=_json_dumps(payload), timeout=timeout)
     resp.raise_for_status()
-    data = resp.json()
+    data = _json_loads(resp.content)
 
     if isinstance(data, dict) and data.get("error"):
         raise RuntimeError(data.get("error"))
@@ -234,12 +547,315 @@ def _call_anthropic_messages(
 
     return ""
 
-def _reset_history(session_id: str, system_prompt: str) -> List[Dict[str, str]]:
-    history: List[Dict[str, str]] = []
+async def _call_provider(
+    provider: str,
+    base_url: str,
+    model_name: str,
+    messages: List[Dict[str, str]],
+    hf_token: str = "",
+    hf_api_url: str = "",
+    api_key: str = "",
+    temperature: Optional[float] = None,
+    top_p: Optional[float] = None,
+    max_new_tokens: Optional[int] = None,
+    session_id: Optional[str] = None,
+) -> str:
+    if provider == "huggingface":
+        return await _call_hf_inference_async(
+            model_name,
+            hf_token,
+            messages,
+            temperature=temperature,
+            top_p=top_p,
+            max_new_tokens=max_new_tokens,
+            api_url=hf_api_url or None,
+        )
+    if provider in ("openai", "deepseek", "qwen"):
+        return await _call_openai_compatible_chat_async(
+            base_url,
+            model_name,
+            api_key,
+            messages,
+            temperature=temperature,
+            top_p=top_p,
+            max_new_tokens=max_new_tokens,
+        )
+    if provider == "claude":
+        return await _call_anthropic_messages_async(
+            base_url,
+            model_name,
+            api_key,
+            messages,
+            temperature=temperature,
+            top_p=top_p,
+            max_new_tokens=max_new_tokens,
+        )
+    options = {}
+    if temperature is not None:
+        options["temperature"] = temperature
+    if top_p is not None:
+        options["top_p"] = top_p
+    if max_new_tokens is not None:
+        options["num_predict"] = max_new_tokens
+    return await _call_ollama_chat_async(
+        base_url, model_name, messages, other_options=options, session_id=session_id
+    )
+
+# Short-lived memo of deterministic (temperature == 0) replies, keyed by request hash.
+_RESP_CACHE: "OrderedDict[bytes, Tuple[float, str]]" = OrderedDict()
+_RESP_CACHE_MAX = 256
+_RESP_CACHE_TTL = 300
+# Upstream calls currently in flight, so identical concurrent requests share one call.
+_inflight: Dict[bytes, asyncio.Future] = {}
+
+def _request_key(
+    provider: str,
+    base_url: str,
+    model_name: str,
+    messages: List[Dict[str, str]],
+    options: Dict[str, object],
+    credential: str = "",
+) -> bytes:
+    # The credential is hashed in so a reply is never served to a different (or invalid) key.
+    body = {"p": provider, "u": base_url, "m": model_name, "msgs": messages, "o": options, "c": credential}
+    return hashlib.blake2b(_json_dumps(body), digest_size=16).digest()
+
+async def _call_provider_cached(
+    provider: str,
+    base_url: str,
+    model_name: str,
+    messages: List[Dict[str, str]],
+    hf_token: str = "",
+    hf_api_url: str = "",
+    api_key: str = "",
+    temperature: Optional[float] = None,
+    top_p: Optional[float] = None,
+    max_new_tokens: Optional[int] = None,
+    session_id: Optional[str] = None,
+) -> str:
+    kwargs = {
+        "hf_token": hf_token,
+        "hf_api_url": hf_api_url,
+        "api_key": api_key,
+        "temperature": temperature,
+        "top_p": top_p,
+        "max_new_tokens": max_new_tokens,
+        "session_id": session_id,
+    }
+    options = {"t": temperature, "p": top_p, "n": max_new_tokens, "h": hf_api_url}
+    credential = hf_token if provider == "huggingface" else api_key
+    key = _request_key(provider, base_url, model_name, messages, options, credential)
+    # Only greedy decoding is reproducible; None means the provider's own sampling default.
+    cacheable = temperature == 0
+
+    if cacheable:
+        now = time.monotonic()
+        while _RESP_CACHE:
+            oldest_key, (stored_at, _) = next(iter(_RESP_CACHE.items()))
+            if now - stored_at <= _RESP_CACHE_TTL:
+                break
+            del _RESP_CACHE[oldest_key]
+
+        hit = _RESP_CACHE.get(key)
+        if hit is not None:
+            return hit[1]
+
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_call_provider(provider, base_url, model_name, messages, **kwargs))
+        _inflight[key] = task
+        task.add_done_callback(lambda done: _inflight.pop(key, None) if _inflight.get(key) is done else None)
+    # Shielded so one caller giving up does not cancel the call for the others.
+    text = await asyncio.shield(task)
+
+    if cacheable:
+        _RESP_CACHE[key] = (time.monotonic(), text)
+        while len(_RESP_CACHE) > _RESP_CACHE_MAX:
+            _RESP_CACHE.popitem(last=False)
+    return text
+
+def _get_session(session_id: str) -> Optional[Session]:
+    session = _chat_sessions.get(session_id)
+    if session is not None:
+        _chat_sessions.move_to_end(session_id)
+    return session
+
+def _store_session(session_id: str, session: Session) -> Session:
+    messages = session.messages
+    head = 1 if messages and messages[0].get("role") == "system" else 0
+    if len(messages) - head > _MAX_HISTORY_MESSAGES:
+        start = len(messages) - _MAX_HISTORY_MESSAGES
+        # Never start the kept window on an assistant reply.
+        while start < len(messages) and messages[start].get("role") == "assistant":
+            start += 1
+        session.messages = messages[:head] + messages[start:]
+        if session.last_assistant_idx >= start:
+            session.last_assistant_idx -= start - head
+        else:
+            session.last_assistant_idx = -1
+        session.rendered_len = 0
+        session.rendered_str = ""
+
+    _chat_sessions[session_id] = session
+    _chat_sessions.move_to_end(session_id)
+    while len(_chat_sessions) > _MAX_SESSIONS:
+        _chat_sessions.popitem(last=False)
+    return session
+
+def _reset_history(session_id: str, system_prompt: str) -> Session:
+    session = Session()
     if system_prompt:
-        history.append({"role": "system", "content": system_prompt})
-    _chat_sessions[session_id] = history
-    return history
+        session.messages.append({"role": "system", "content": system_prompt})
+    return _store_session(session_id, session)
+
+def _last_assistant_index(messages: List[Dict[str, str]]) -> int:
+    for idx in range(len(messages) - 1, -1, -1):
+        if messages[idx].get("role") == "assistant":
+            return idx
+    return -1
+
+def _compact_history(
+    messages: List[Dict[str, str]], max_chars: int = MAX_CONTEXT_CHARS
+) -> List[Dict[str, str]]:
+    """
+    Bound the request-side history: keep the system prompt and the most recent turns
+    that fit in `max_chars`, and replace the older middle turns with a short note.
+    """
+    if max_chars <= 0:
+        return messages
+    if sum(len(msg.get("content", "")) for msg in messages) <= max_chars:
+        return messages
+
+    head = 1 if messages and messages[0].get("role") == "system" else 0
+    budget = max_chars - sum(len(msg.get("content", "")) for msg in messages[:head])
+    # The latest message is always kept, even if it alone exceeds the budget.
+    start = len(messages) - 1
+    budget -= len(messages[start].get("content", ""))
+    while start - 1 >= head:
+        size = len(messages[start - 1].get("content", ""))
+        if size > budget:
+            break
+        budget -= size
+        start -= 1
+    # Never start the kept window on an assistant reply.
+    while start < len(messages) - 1 and messages[start].get("role") == "assistant":
+        start += 1
+
+    omitted = start - head
+    if omitted <= 0:
+        return messages
+    note = {
+        "role": "system",
+        "content": f"[earlier conversation omitted: {omitted} messages]",
+    }
+    return messages[:head] + [note] + messages[start:]
+
+def _parse_max_context_chars(value: object) -> int:
+    # The HTTP route forwards client JSON unchecked; null, "" or junk means the default.
+    if value is None or value == "":
+        return MAX_CONTEXT_CHARS
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return MAX_CONTEXT_CHARS
+
+def _format_messages(messages: List[Dict[str, str]]) -> str:
+    return "".join(
+        f"{msg.get('role', 'unknown').capitalize()}: {msg.get('content', '')}\n\n"
+        for msg in messages
+    )
+
+def _render_history(session: Session) -> str:
+    # History only grows between resets/regenerates, so render just the new tail.
+    messages = session.messages
+    if session.rendered_len > len(messages):
+        session.rendered_len = 0
+        session.rendered_str = ""
+    session.rendered_str += _format_messages(messages[session.rendered_len:])
+    session.rendered_len = len(messages)
+    return session.rendered_str
+
+async def _complete_turn(
+    session_id: str,
+    session: Session,
+    messages: List[Dict[str, str]],
+    last_assistant_idx: int,
+    llm: Dict[str, object],
+    grows_from: Optional[List[Dict[str, str]]] = None,
+):
+    """
+    `grows_from` is the stored list `messages` was copied from and only appended to.
+    The render cache is kept only if that list is still the one stored on the session.
+    """
+    response_text = ""
+    if messages and messages[-1].get("role") == "user":
+        upstream_messages = _compact_history(messages, llm["max_context_chars"])
+        try:
+            response_text = await _call_provider_cached(
+                llm["provider"],
+                llm["base_url"],
+                llm["model_name"],
+                upstream_messages,
+                hf_token=llm["hf_token"],
+                hf_api_url=llm["hf_api_url"],
+                api_key=llm["api_key"],
+                temperature=llm["temperature"],
+                top_p=llm["top_p"],
+                max_new_tokens=llm["max_new_tokens"],
+                session_id=session_id,
+            )
+            last_assistant_idx = len(messages)
+            messages.append({"role": "assistant", "content": response_text})
+        except Exception as exc:
+            response_text = f"[chat error] {exc}"
+
+    # Another turn (or a regenerate) may have replaced the history while we awaited.
+    if grows_from is None or session.messages is not grows_from:
+        session.rendered_len = 0
+        session.rendered_str = ""
+    session.messages = messages
+    session.last_assistant_idx = last_assistant_idx
+    session = _store_session(session_id, session)
+
+    return ("", _render_history(session))
+
+async def _do_send(session_id: str, session: Session, user_message: str, system_prompt: str, llm: Dict[str, object]):
+    # Work on a copy: the stored history must not change while the upstream call is in flight.
+    messages = list(session.messages)
+    if user_message.strip():
+        messages.append({"role": "user", "content": user_message})
+    return await _complete_turn(
+        session_id, session, messages, session.last_assistant_idx, llm, grows_from=session.messages
+    )
+
+async def _do_regenerate(session_id: str, session: Session, user_message: str, system_prompt: str, llm: Dict[str, object]):
+    last_assistant_idx = session.last_assistant_idx
+    if last_assistant_idx >= 0:
+        messages = session.messages[:last_assistant_idx]
+        # The previous assistant turn sits right before the dropped user turn.
+        last_assistant_idx = _last_assistant_index(messages)
+        return await _complete_turn(session_id, session, messages, last_assistant_idx, llm)
+    messages = list(session.messages)
+    return await _complete_turn(
+        session_id, session, messages, last_assistant_idx, llm, grows_from=session.messages
+    )
+
+async def _do_clear(session_id: str, session: Optional[Session], user_message: str, system_prompt: str, llm: Dict[str, object]):
+    _reset_history(session_id, system_prompt)
+    return ("", "")
+
+async def _do_deliver(session_id: str, session: Session, user_message: str, system_prompt: str, llm: Dict[str, object]):
+    latest_response = ""
+    if session.last_assistant_idx >= 0:
+        latest_response = session.messages[session.last_assistant_idx].get("content", "")
+    return (latest_response, _format_messages(session.messages))
+
+_ACTION_HANDLERS = {
+    "send": _do_send,
+    "regenerate": _do_regenerate,
+    "clear": _do_clear,
+    "deliver_to_optimizer": _do_deliver,
+}
 
 class ChatNode:
     @classmethod
@@ -266,7 +882,10 @@ class ChatNode:
     CATEGORY = "ChatOptimize"
     OUTPUT_NODE = False
 
-    def chat(
+    def chat(self, *args, **kwargs):
+        return _run_sync(self.achat(*args, **kwargs))
+
+    async def achat(
         self,
         model_name: str,
         base_url: str,
@@ -278,118 +897,42 @@ class ChatNode:
         auto_clear_input: bool = True,
         llm_config: Optional[Dict] = None,
     ):
-        provider = "ollama"
-        hf_token = ""
-        hf_api_url = ""
-        api_key = ""
-        temperature = None
-        top_p = None
-        max_new_tokens = None
+        llm: Dict[str, object] = {
+            "provider": "ollama",
+            "base_url": base_url,
+            "model_name": model_name,
+            "hf_token": "",
+            "hf_api_url": "",
+            "api_key": "",
+            "temperature": None,
+            "top_p": None,
+            "max_new_tokens": None,
+            "max_context_chars": MAX_CONTEXT_CHARS,
+        }
         if llm_config:
-            provider = llm_config.get("provider", provider)
-            model_name = llm_config.get("model_name", model_name)
-            base_url = llm_config.get("base_url", base_url)
-            hf_token = llm_config.get("hf_token", "")
-            hf_api_url = llm_config.get("hf_api_url", "")
-            api_key = llm_config.get("api_key", "")
-            if "temperature" in llm_config:
-                temperature = llm_config["temperature"]
-            if "top_p" in llm_config:
-                top_p = llm_config["top_p"]
-            if "max_new_tokens" in llm_config:
-                max_new_tokens = llm_config["max_new_tokens"]
-
-        if refresh_session or session_id not in _chat_sessions:
-            history = _reset_history(session_id, system_prompt)
-        else:
-            history = _chat_sessions.get(session_id, [])
+            for key in ("provider", "base_url", "model_name", "hf_token", "hf_api_url", "api_key",
+                        "temperature", "top_p", "max_new_tokens"):
+                if key in llm_config:
+                    llm[key] = llm_config[key]
+            llm["max_context_chars"] = _parse_max_context_chars(llm_config.get("max_context_chars"))
 
-        if action == "clear":
-            history = _reset_history(session_id, system_prompt)
-            return ("", "")
+        # Resolve the handler first so a clear never has to look at the old history.
+        handler = _ACTION_HANDLERS.get(action, _do_send)
+        if handler is _do_clear:
+            return await handler(session_id, None, user_message, system_prompt, llm)
+        if handler is not _do_deliver:
+            # Overlap the handshake with the history work before the upstream call.
+            _warm_endpoint(_provider_endpoint(llm["provider"], llm["base_url"], llm["hf_api_url"]))
+
+        session = None if refresh_session else _get_session(session_id)
+        if session is None:
+            session = _reset_history(session_id, system_prompt)
 
         if system_prompt:
-            if not history or history[0].get("role") != "system":
-                history = _reset_history(session_id, system_prompt)
-
-        messages = list(history)
-
-        if action == "send":
-            if user_message.strip():
-                messages.append({"role": "user", "content": user_message})
-        elif action == "regenerate":
-            for idx in range(len(messages) - 1, -1, -1):
-                if messages[idx].get("role") == "assistant":
-                    messages = messages[:idx]
-                    break
-        elif action == "deliver_to_optimizer":
-            latest_response = ""
-            for msg in reversed(messages):
-                if msg.get("role") == "assistant":
-                    latest_response = msg.get("content", "")
-                    break
-            readable_history = ""
-            for msg in messages:
-                role = msg.get("role", "unknown").capitalize()
-                content = msg.get("content", "")
-                readable_history += f"{role}: {content}\n\n"
-            return (latest_response, readable_history)
-
-        response_text = ""
-        if messages and messages[-1].get("role") == "user":
-            try:
-                if provider == "huggingface":
-                    response_text = _call_hf_inference(
-                        model_name,
-                        hf_token,
-                        messages,
-                        temperature=temperature,
-                        top_p=top_p,
-                        max_new_tokens=max_new_tokens,
-                        api_url=hf_api_url or None,
-                    )
-                elif provider in ("openai", "deepseek", "qwen"):
-                    response_text = _call_openai_compatible_chat(
-                        base_url,
-                        model_name,
-                        api_key,
-                        messages,
-                        temperature=temperature,
-                        top_p=top_p,
-                        max_new_tokens=max_new_tokens,
-                    )
-                elif provider == "claude":
-                    response_text = _call_anthropic_messages(
-                        base_url,
-                        model_name,
-                        api_key,
-                        messages,
-                        temperature=temperature,
-                        top_p=top_p,
-                        max_new_tokens=max_new_tokens,
-                    )
-                else:
-                    options = {}
-                    if temperature is not None:
-                        options["temperature"] = temperature
-                    if top_p is not None:
-                        options["top_p"] = top_p
-                    if max_new_tokens is not None:
-                        options["num_predict"] = max_new_tokens
-                    response_text = _call_ollama_chat(base_url, model_name, messages, other_options=options)
-                messages.append({"role": "assistant", "content": response_text})
-            except Exception as exc:
-                response_text = f"[chat error] {exc}"
-
-        _chat_sessions[session_id] = messages
-        
-        readable_history = ""
-        for msg in messages:
-            role = msg.get("role", "unknown").capitalize()
-            content = msg.get("content", "")
-            readable_history += f"{role}: {content}\n\n"
-
-        return ("", readable_history)
+            if not session.messages or session.messages[0].get("role") != "system":
+                session = _reset_history(session_id, system_prompt)
+
+        return await handler(session_id, session, user_message, system_prompt, llm)
 
 class LLMConfigNode:
     @classmethod
@@ -405,7 +948,10 @@ class LLMConfigNode:
                 "hf_token": ("STRING", {"default": ""}),
                 "hf_api_url": ("STRING", {"default": ""}),
                 "api_key": ("STRING", {"default": ""}),
-            }
+            },
+            "optional": {
+                "max_context_chars": ("INT", {"default": MAX_CONTEXT_CHARS, "min": 0, "max": 1000000, "step": 100}),
+            },
         }
 
     RETURN_TYPES = ("LLM_CONFIG",)
@@ -413,7 +959,9 @@ class LLMConfigNode:
     FUNCTION = "config"
     CATEGORY = "ChatOptimize"
 
-    def config(self, provider, base_url, model_name, temperature, top_p, max_new_tokens, hf_token, hf_api_url, api_key):
+    def config(self, provider, base_url, model_name, temperature, top_p, max_new_tokens, hf_token, hf_api_url, api_key, max_context_chars=MAX_CONTEXT_CHARS):
+        # Runs ahead of the Chat node in the graph: a good moment to open the connection.
+        _warm_endpoint(_provider_endpoint(provider, base_url, hf_api_url))
         return (
             {
                 "provider": provider,
@@ -425,6 +973,7 @@ class LLMConfigNode:
                 "hf_token": hf_token,
                 "hf_api_url": hf_api_url,
                 "api_key": api_key,
+                "max_context_chars": max_context_chars,
             },
         )
 
@@ -447,9 +996,10 @@ class ChatHistoryViewer:
     def show(self, history=""):
         return {"ui": {"text": [history]}, "result": (history,)}
 
-def _chat_action(data: Dict[str, object]):
+async def _chat_action_async(data: Dict[str, object]):
+    # Runs on the server loop itself: no executor thread is held for the upstream round-trip.
     node = ChatNode()
-    return node.chat(
+    return await node.achat(
         model_name=data.get("model_name", "llama3"),
         base_url=data.get("base_url", "http://127.0.0.1:11434"),
         user_message=data.get("user_message", ""),
@@ -463,9 +1013,8 @@ def _chat_action(data: Dict[str, object]):
 @PromptServer.instance.routes.post("/chat_optimize/chat")
 async def chat_endpoint(request):
     payload = await request.json()
-    loop = asyncio.get_event_loop()
     try:
-        assistant_response, readable_history = await loop.run_in_executor(None, _chat_action, payload)
+        assistant_response, readable_history = await _chat_action_async(payload)
         return web.json_response(
             {
                 "assistant_response": assistant_response,
@@ -475,6 +1024,8 @@ async def chat_endpoint(request):
     except Exception as exc:
         return web.json_response({"error": str(exc)}, status=500)
 
+_schedule_prewarm()
+
 NODE_CLASS_MAPPINGS = {
     "ChatNode": ChatNode,
     "LLMConfigNode": LLMConfigNode,
@@ -5,6 +5,9 @@ import { ComfyWidgets } from "/scripts/widgets.js";
 const CHAT_CLASSES = ["ChatNode", "Chat"];
 const VIEWER_CLASS = "ChatHistoryViewer";
 const ROUTE_CHAT = "/chat_optimize/chat";
+const EVENT_TOKEN = "chat_optimize.token";
+const EVENT_DONE = "chat_optimize.done";
+const STREAM_PREVIEW_CHARS = 80;
 let historyModal = null;
 
 function ensureHistoryModal() {
@@ -196,6 +199,9 @@ function getLLMConfig(node) {
     const apiKeyW = sourceNode.widgets?.find(w => w.name === "api_key");
     if (apiKeyW) config.api_key = apiKeyW.value;
 
+    const maxContextW = sourceNode.widgets?.find(w => w.name === "max_context_chars");
+    if (maxContextW) config.max_context_chars = maxContextW.value;
+
     return config;
 }
 
@@ -226,11 +232,40 @@ function setupChatNode(node) {
     let historyStore = addOrGetWidget(node, "hidden", "history_preview", { default: "" });
     let responseStore = addOrGetWidget(node, "hidden", "assistant_response_preview", { default: "" });
 
+    // Ollama replies are streamed over the websocket; preview the tail in the status line.
+    // Only the preview tail is kept, so queued runs never accumulate the whole reply.
+    let streamed = "";
+    const isOwnSession = (detail) => {
+        const sessionId = node.widgets?.find((w) => w.name === "session_id")?.value ?? "default";
+        return !!detail && detail.session_id === sessionId;
+    };
+    const onToken = ({ detail }) => {
+        if (!isOwnSession(detail)) return;
+        streamed = (streamed + (detail.delta || "")).slice(-STREAM_PREVIEW_CHARS);
+        statusWidget.value = `streaming: ${streamed}`;
+        node.setDirtyCanvas(true, true);
+    };
+    const onDone = ({ detail }) => {
+        if (!isOwnSession(detail)) return;
+        streamed = "";
+        statusWidget.value = "done";
+        node.setDirtyCanvas(true, true);
+    };
+    api.addEventListener(EVENT_TOKEN, onToken);
+    api.addEventListener(EVENT_DONE, onDone);
+    const originalOnRemoved = node.onRemoved;
+    node.onRemoved = function () {
+        api.removeEventListener(EVENT_TOKEN, onToken);
+        api.removeEventListener(EVENT_DONE, onDone);
+        if (originalOnRemoved) return originalOnRemoved.apply(this, arguments);
+    };
+
     const sendAction = async () => {
         const actionWidget = node.widgets?.find((w) => w.name === "action");
         const action = actionWidget ? actionWidget.value : "send";
         
         try {
+            streamed = "";
             statusWidget.value = `working: ${action}...`;
             node.setDirtyCanvas(true, true);
             